@@ -0,0 +1,13 @@
+"""
+FreeBSD release/snapshot VMDK to OVA converter
+"""
+
+from .backend import BackendException, available_backends, get_backend
+from .cache import GrainCache
+from .ova import HardwareProfile, OVAException, OVAFile, convert, convert_batch, \
+    repack
+from .vmdk import ConversionStats, VMDKException, stream_optimize_vmdk
+
+__all__ = [ 'BackendException', 'ConversionStats', 'GrainCache', 'HardwareProfile',
+    'OVAException', 'OVAFile', 'VMDKException', 'available_backends', 'convert',
+    'convert_batch', 'get_backend', 'repack', 'stream_optimize_vmdk' ]
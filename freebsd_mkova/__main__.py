@@ -0,0 +1,220 @@
+import argparse
+import shlex
+import tarfile
+
+from .backend import BACKENDS, BackendException, get_backend
+from .cache import DEFAULT_CACHE_SIZE, GrainCache
+from .ova import HardwareProfile, OVAException, convert, convert_batch, repack
+from .vmdk import ADAPTIVE_LEVEL, ARCHIVAL_LEVEL, DEFAULT_BUFFER_SIZE, \
+    DEFAULT_COMPRESS_LEVEL, DIGESTS, default_jobs
+
+def digest_list(s):
+    digests = []
+    for d in s.lower().split(','):
+        if d not in DIGESTS:
+            raise argparse.ArgumentTypeError(f'unsupported digest: {d}')
+        if d not in digests:
+            digests.append(d)
+    return digests
+
+def compress_level(s):
+    if s in (ADAPTIVE_LEVEL, ARCHIVAL_LEVEL):
+        return s
+    try:
+        level = int(s)
+    except ValueError:
+        level = -1
+    if not 0 <= level <= 9:
+        raise argparse.ArgumentTypeError(f'invalid compression level: {s}')
+    return level
+
+def profile_spec(s):
+    """
+    Parse OVA variant spec: comma-separated key=value pairs with keys
+    output (required), cpus, memsize and name
+    """
+    spec = {}
+    for kv in s.split(','):
+        key, sep, value = kv.partition('=')
+        if not sep or key not in ('output', 'cpus', 'memsize', 'name'):
+            raise argparse.ArgumentTypeError(f'invalid profile item: {kv}')
+        if key in ('cpus', 'memsize'):
+            try:
+                value = int(value)
+            except ValueError:
+                raise argparse.ArgumentTypeError(f'invalid {key}: {value}')
+        spec[key] = value
+    if 'output' not in spec:
+        raise argparse.ArgumentTypeError('profile requires output')
+    return spec
+
+def read_job_list(path):
+    """
+    Read batch job list: one "vmdkfile [output]" per line, shell-style
+    quoting, empty lines and lines starting with # are ignored
+    """
+    images = []
+    with open(path) as f:
+        for line in f:
+            words = shlex.split(line, comments=True)
+            if not words:
+                continue
+            if len(words) > 2:
+                raise ValueError(f'{path}: invalid job: {line.strip()}')
+            images.append((words[0], words[1] if len(words) > 1 else None))
+    return images
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='freebsd-mkova',
+                        description='FreeBSD release/snapshot VMDK to OVA converter')
+    parser.add_argument('vmdk', metavar='vmdkfile', type=str, nargs='*',
+                        help='VMDK file(s)')
+    parser.add_argument('--backend', metavar='backend', choices=BACKENDS,
+                        help='deflate implementation: ' + ', '.join(BACKENDS)
+                        + ' (default: first one installed)')
+    parser.add_argument('-b', '--buffer-size', metavar='buffersize', type=int,
+                        default=DEFAULT_BUFFER_SIZE // (1024 * 1024),
+                        help='memory limit for grains in flight in MB')
+    parser.add_argument('--cache-dir', metavar='cachedir', type=str,
+                        help='directory of persistent compressed grain cache')
+    parser.add_argument('--cache-size', metavar='cachesize', type=int,
+                        default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+                        help='grain cache size limit in MB')
+    parser.add_argument('--compress-level', metavar='level',
+                        type=compress_level, default=DEFAULT_COMPRESS_LEVEL,
+                        help='deflate level 0-9, ' + ADAPTIVE_LEVEL
+                        + ' to pick one per grain by its entropy, or '
+                        + ARCHIVAL_LEVEL + ' for the smallest output the '
+                        'backend can make, on all cores by default '
+                        f'(default: {DEFAULT_COMPRESS_LEVEL})')
+    parser.add_argument('-c', '--cpus', metavar='cpus', type=int,
+                        help='number of CPUs (default: 1)')
+    parser.add_argument('-d', '--disksize', metavar='disksize', type=int,
+                        default=10, help='disk size in GB')
+    parser.add_argument('--digest', metavar='digests', type=digest_list,
+                        help='comma-separated list of manifest digests: '
+                        + ', '.join(DIGESTS) + ' (default: sha1)')
+    parser.add_argument('--hash-input', action='store_true',
+                        help='with --skip-unchanged also compare the content '
+                        'of vmdkfile, not only its size and time')
+    parser.add_argument('-j', '--jobs', metavar='jobs', type=int,
+                        help='number of grain compression threads '
+                        '(default: 1)')
+    parser.add_argument('-l', '--job-list', metavar='joblist', type=str,
+                        help='file with one "vmdkfile [output]" per line')
+    parser.add_argument('-m', '--memsize', metavar='memsize', type=int,
+                        help='amount of memory in MB (default: 1024)')
+    parser.add_argument('--mmap', action='store_true',
+                        help='memory-map the input file')
+    parser.add_argument('-n', '--name', metavar='name', type=str,
+                        help='VM name')
+    parser.add_argument('-o', '--output', metavar='output', type=str,
+                        help='output file, single vmdkfile only')
+    parser.add_argument('-p', '--profile', metavar='profile', type=profile_spec,
+                        action='append', default=[],
+                        help='also write OVA variant output=file[,cpus=N]'
+                        '[,memsize=N][,name=name] from the same disk, '
+                        'single vmdkfile only')
+    parser.add_argument('-P', '--processes', action='store_true',
+                        help='compress in worker processes instead of '
+                        'threads, not with --cache-dir')
+    parser.add_argument('--pwrite', action='store_true',
+                        help='write grains to their place in the output '
+                        'file from jobs threads')
+    parser.add_argument('-r', '--repack', metavar='ovafile', type=str,
+                        help='rebuild existing OVA with new CPUs, memory or '
+                        'name without converting the disk again, settings '
+                        'not given are kept')
+    parser.add_argument('--reproducible', action='store_true',
+                        help='derive disk content IDs from vmdkfile and set '
+                        'file times to SOURCE_DATE_EPOCH or 0, so the same '
+                        'input always gives the same OVA')
+    parser.add_argument('--segments', action='store_true',
+                        help='compress all grains of a grain table in one '
+                        'task, the buffer size should hold jobs x 32 MB')
+    parser.add_argument('-s', '--skip-unchanged', action='store_true',
+                        help='keep an existing OVA built from the same '
+                        'vmdkfile with the same settings')
+
+    args = parser.parse_args(argv)
+    if args.jobs is None:
+        args.jobs = default_jobs(args.compress_level)
+    if args.jobs < 1:
+        parser.error('number of jobs must be at least 1')
+    if args.buffer_size < 1:
+        parser.error('buffer size must be at least 1 MB')
+
+    if args.repack is not None:
+        if args.vmdk or args.job_list or args.profile:
+            parser.error('--repack does not take vmdkfiles or profiles')
+        try:
+            repack(args.repack, output=args.output, cpus=args.cpus,
+                memsize=args.memsize, name=args.name, digests=args.digest,
+                reproducible=args.reproducible)
+        except (OSError, OVAException, tarfile.TarError) as e:
+            parser.exit(1, f'{parser.prog}: {e}\n')
+        return
+
+    if args.cpus is None:
+        args.cpus = 1
+    if args.memsize is None:
+        args.memsize = 1024
+    if args.digest is None:
+        args.digest = ['sha1']
+
+    images = [ (vmdk, None) for vmdk in args.vmdk ]
+    if args.job_list is not None:
+        try:
+            images += read_job_list(args.job_list)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+    if not images:
+        parser.error('no vmdkfile given')
+
+    try:
+        get_backend(args.backend)
+    except BackendException as e:
+        parser.error(str(e))
+
+    cache = None
+    if args.cache_dir is not None:
+        if args.processes:
+            parser.error('--cache-dir can not be used with --processes')
+        cache = GrainCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    options = dict(cpus=args.cpus, memsize=args.memsize,
+        disksize=args.disksize, name=args.name, digests=args.digest,
+        jobs=args.jobs, buffer_size=args.buffer_size * 1024 * 1024,
+        use_mmap=args.mmap, processes=args.processes, segments=args.segments,
+        positional=args.pwrite,
+        cache=cache,
+        backend=args.backend,
+        compress_level=args.compress_level,
+        reproducible=args.reproducible,
+        skip_unchanged=args.skip_unchanged,
+        hash_input=args.hash_input)
+
+    if len(images) == 1:
+        vmdk, output = images[0]
+        profiles = [ HardwareProfile(p['output'], cpus=p.get('cpus', args.cpus),
+            memsize=p.get('memsize', args.memsize), name=p.get('name', args.name))
+            for p in args.profile ]
+        results = [ convert(vmdk, output=args.output or output,
+            profiles=profiles, **options) ]
+    else:
+        if args.output is not None:
+            parser.error('--output requires a single vmdkfile')
+        if args.profile:
+            parser.error('--profile requires a single vmdkfile')
+        results = convert_batch(images, **options)
+
+    if args.compress_level == ARCHIVAL_LEVEL:
+        for stats in results:
+            default_size = stats.output_size + stats.saved_size
+            print(f'{stats.output}: disk {stats.output_size} bytes, '
+                f'{stats.saved_size} bytes '
+                f'({stats.saved_size / default_size:.1%}) '
+                f'smaller than level {DEFAULT_COMPRESS_LEVEL}')
+
+if __name__ == '__main__':
+    main()
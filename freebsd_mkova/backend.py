@@ -0,0 +1,138 @@
+import os
+import zlib
+
+try:
+    import deflate
+except ImportError:
+    deflate = None
+
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+try:
+    from zlib_ng import zlib_ng
+except ImportError:
+    zlib_ng = None
+
+try:
+    import zopfli.zlib
+except ImportError:
+    zopfli = None
+
+# ISA-L has levels 0-3 only, its level 0 still compresses
+ISAL_LEVELS = (0, 1, 1, 1, 2, 2, 2, 3, 3, 3)
+
+# libdeflate goes beyond zlib level 9
+LIBDEFLATE_BEST_LEVEL = 12
+
+# zopfli has no levels, only a number of iterations
+ZOPFLI_ITERATIONS = 15
+
+# Data every backend has to round-trip through stdlib zlib at all
+# levels before it is used
+SELF_CHECK_DATA = (b'', bytes(65536), os.urandom(65536),
+    b''.join(b'%d FreeBSD\n' % i for i in range(6000)))
+
+class BackendException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return self.msg
+
+class DeflateBackend(object):
+    """
+    Deflate implementation name, compress(data, level) returns a zlib
+    stream of data compressed with zlib level 0-9 or best_level, its
+    highest effort. levels are the levels with distinct output
+    """
+
+    def __init__(self, name, compress, best_level=9, levels=range(1, 10)):
+        self.name = name
+        self.best_level = best_level
+        self.levels = levels
+        self.__compress = compress
+
+    def __reduce__(self):
+        # worker processes look the backend up by name
+        return get_backend, (self.name,)
+
+    def compress(self, data, level):
+        # stored blocks are the same with any implementation
+        if level == 0:
+            return zlib.compress(data, 0)
+        return self.__compress(data, level)
+
+    def check(self):
+        """
+        Raise BackendException unless stdlib zlib decodes the output
+        """
+        for data in SELF_CHECK_DATA:
+            for level in (0, *self.levels, self.best_level):
+                try:
+                    ok = zlib.decompress(self.compress(data, level)) == data
+                except Exception:
+                    ok = False
+                if not ok:
+                    raise BackendException(f'{self.name} deflate backend '
+                        f'output at level {level} does not decode with zlib')
+
+def isal_compress(data, level):
+    return isal_zlib.compress(data, ISAL_LEVELS[level])
+
+def zopfli_compress(data, level):
+    return zopfli.zlib.compress(bytes(data), numiterations=ZOPFLI_ITERATIONS)
+
+# Deflate backends by name in order of preference: libdeflate is
+# fastest at the same or better ratio, zlib-ng and ISA-L trade some
+# ratio for speed. zopfli is the exhaustive encoder, 100 times slower
+# than zlib level 9, and never chosen by default. None if not installed
+BACKENDS = {
+    'libdeflate': deflate and deflate.zlib_compress,
+    'zlib-ng': zlib_ng and zlib_ng.compress,
+    'isal': isal_zlib and isal_compress,
+    'zlib': zlib.compress,
+    'zopfli': zopfli and zopfli_compress,
+}
+
+# Backend arguments beyond the defaults of DeflateBackend
+BACKEND_OPTIONS = {
+    'libdeflate': dict(best_level=LIBDEFLATE_BEST_LEVEL),
+    'isal': dict(levels=(1, 4, 7)),
+    'zopfli': dict(levels=()),
+}
+
+_checked = {}
+
+def available_backends():
+    """
+    Return names of the installed deflate backends, preferred first,
+    without zopfli
+    """
+    return [ name for name, compress in BACKENDS.items()
+        if compress and name != 'zopfli' ]
+
+def get_backend(name=None):
+    """
+    Return DeflateBackend name or, if None, the most preferred installed
+    backend that passes its self-check. Backends are checked on first use
+    """
+    if name is None:
+        for name in available_backends():
+            try:
+                return get_backend(name)
+            except BackendException:
+                continue
+
+    if name not in BACKENDS:
+        raise BackendException(f'unknown deflate backend: {name}')
+    if not BACKENDS[name]:
+        raise BackendException(f'deflate backend {name} is not installed')
+
+    if name not in _checked:
+        backend = DeflateBackend(name, BACKENDS[name],
+            **BACKEND_OPTIONS.get(name, {}))
+        backend.check()
+        _checked[name] = backend
+    return _checked[name]
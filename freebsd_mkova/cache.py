@@ -0,0 +1,284 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+from .vmdk import ConversionStats
+
+# Default size limit of the grain cache
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Temporary entries older than this are left over from crashed runs
+STALE_TEMP_AGE = 3600
+
+# Names the cache gives its subdirectories, entries and temporary
+# entries, anything else in the directory is left alone
+CACHE_DIR_RE = re.compile(r'[0-9a-f]{2}')
+CACHE_ENTRY_RE = re.compile(r'[0-9a-f]{38}')
+CACHE_TEMP_RE = re.compile(r'tmp[a-z0-9_]{8}\.tmp')
+
+log = logging.getLogger(__name__)
+
+# Build record written next to the OVA, bump the version whenever the
+# same input and parameters produce a different OVA
+BUILD_RECORD_SUFFIX = '.build'
+BUILD_RECORD_VERSION = 2
+
+# Read size for hashing the input file
+HASH_BUFFER_SIZE = 1024 * 1024
+
+class GrainCache(object):
+    """
+    Persistent content-addressed cache of compressed grains in directory
+    path. Entries are keyed by blake2b hash of the uncompressed grain and
+    the compression parameters and hold the deflated bytes. When the
+    cache grows over limit bytes least recently used entries are evicted.
+    The file modification time records the last use, so the LRU order
+    carries over between runs. Entry sizes count whole filesystem
+    blocks. The cache is best-effort: failing to store an entry is
+    logged and the grain is simply not cached. Files the cache did not
+    name are left alone, so path may be shared with other data. Safe to
+    use from several threads and processes
+    """
+
+    def __init__(self, path, limit=DEFAULT_CACHE_SIZE):
+        self.__path = path
+        self.__limit = limit
+        self.__lock = threading.Lock()
+        self.__size = 0
+        # key -> entry size, least recently used first
+        self.__entries = OrderedDict()
+        self.__failed = False
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.__block_size = os.statvfs(path).f_frsize or 4096
+        stale = time.time() - STALE_TEMP_AGE
+        # subdirectories take blocks too, they count against the limit
+        self.__dirs = set()
+        found = []
+        for d in os.scandir(path):
+            try:
+                if not CACHE_DIR_RE.fullmatch(d.name) or not d.is_dir():
+                    continue
+                entries = list(os.scandir(d.path))
+            except OSError:
+                continue
+            self.__dirs.add(d.name)
+            self.__size += self.__block_size
+            for e in entries:
+                entry = CACHE_ENTRY_RE.fullmatch(e.name)
+                if not entry and not CACHE_TEMP_RE.fullmatch(e.name):
+                    continue
+                try:
+                    st = e.stat()
+                except OSError:
+                    # evicted by another process meanwhile
+                    continue
+                if not entry:
+                    # another run may still be writing recent ones
+                    if st.st_mtime < stale:
+                        self.__remove_file(e.path)
+                    continue
+                found.append((st.st_mtime, d.name + e.name,
+                    self.__disk_size(st.st_size)))
+        for _, key, size in sorted(found):
+            self.__entries[key] = size
+            self.__size += size
+
+        # the limit may have been lowered since the last run
+        self.__remove(self.__evict())
+
+    def __disk_size(self, size):
+        return size + (-size % self.__block_size)
+
+    def __entry_path(self, key):
+        return os.path.join(self.__path, key[:2], key[2:])
+
+    def key(self, grain, params=b''):
+        """
+        Return cache key of uncompressed grain data compressed with
+        compressor parameters params
+        """
+        h = hashlib.blake2b(params, digest_size=20)
+        h.update(grain)
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Return cached compressed grain or None
+        """
+        with self.__lock:
+            if key not in self.__entries:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+
+        path = self.__entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            # evicted by another process sharing the directory
+            data = b''
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        with self.__lock:
+            if not data:
+                self.__forget(key)
+                self.misses += 1
+                return None
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """
+        Store compressed grain data and evict entries over the limit
+        """
+        path = self.__entry_path(key)
+        temp = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp = tempfile.mkstemp(suffix='.tmp',
+                dir=os.path.dirname(path))
+            with open(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp, path)
+        except OSError as e:
+            if temp is not None:
+                self.__remove_file(temp)
+            with self.__lock:
+                failed, self.__failed = self.__failed, True
+            if not failed:
+                log.warning('grain cache %s: can not store grains: %s',
+                    self.__path, e)
+            return
+
+        size = self.__disk_size(len(data))
+        with self.__lock:
+            if key[:2] not in self.__dirs:
+                self.__dirs.add(key[:2])
+                self.__size += self.__block_size
+            self.__forget(key)
+            self.__entries[key] = size
+            self.__size += size
+            evicted = self.__evict()
+
+        self.__remove(evicted)
+
+    def __evict(self):
+        # drop least recently used entries over the limit from the index,
+        # return their keys
+        evicted = []
+        while self.__size > self.__limit and self.__entries:
+            key, size = self.__entries.popitem(last=False)
+            self.__size -= size
+            evicted.append(key)
+        return evicted
+
+    def __remove(self, keys):
+        for key in keys:
+            self.__remove_file(self.__entry_path(key))
+
+    def __remove_file(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def __forget(self, key):
+        size = self.__entries.pop(key, None)
+        if size is not None:
+            self.__size -= size
+
+def input_identity(path, content_hash=False):
+    """
+    Return identity of input file path: its name, size and modification
+    time and, if content_hash is set, the sha256 of its content
+    """
+    st = os.stat(path)
+    identity = dict(name=os.path.basename(path), size=st.st_size,
+        mtime=st.st_mtime_ns)
+    if content_hash:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                b = f.read(HASH_BUFFER_SIZE)
+                if not b:
+                    break
+                h.update(b)
+        identity['sha256'] = h.hexdigest()
+    return identity
+
+def build_key(path, params, content_hash=False):
+    """
+    Return key of converting input file path with conversion parameters
+    params, a dict of JSON-serializable values
+    """
+    key = dict(version=BUILD_RECORD_VERSION, params=params,
+        input=input_identity(path, content_hash))
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def output_identity(path):
+    """
+    Return identity of output file path: its size and modification time
+    """
+    st = os.stat(path)
+    return [ st.st_size, st.st_mtime_ns ]
+
+def load_build(output, key):
+    """
+    Return ConversionStats of the build recorded next to OVA file output
+    if it was made with key and none of its outputs changed since,
+    else None
+    """
+    try:
+        with open(output + BUILD_RECORD_SUFFIX) as f:
+            record = json.load(f)
+        if record.get('key') != key:
+            return None
+        for path, identity in record['outputs'].items():
+            if output_identity(path) != identity:
+                return None
+        stats = ConversionStats()
+        for attr in ('grains', 'zero_grains', 'grain_tables', 'output_size',
+              'digests', 'saved_size'):
+            setattr(stats, attr, record['stats'][attr])
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+    stats.reused = True
+    return stats
+
+def save_build(output, key, stats, outputs):
+    """
+    Record next to OVA file output that it and the other files in outputs
+    were built with key, with result ConversionStats stats
+    """
+    record = dict(key=key,
+        outputs={ path: output_identity(path) for path in outputs },
+        stats=dict(grains=stats.grains, zero_grains=stats.zero_grains,
+            grain_tables=stats.grain_tables, output_size=stats.output_size,
+            digests=stats.digests, saved_size=stats.saved_size))
+    temp = output + BUILD_RECORD_SUFFIX + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(record, f, sort_keys=True)
+    os.replace(temp, output + BUILD_RECORD_SUFFIX)
+
+def discard_build(output):
+    """
+    Remove the build record of OVA file output before it is rewritten
+    """
+    try:
+        os.unlink(output + BUILD_RECORD_SUFFIX)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,657 @@
+import hashlib
+import os
+import re
+import tarfile
+import time
+import xml.dom.minidom
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from xml.etree import ElementTree as ET
+from xml.etree.ElementTree import Element, SubElement
+
+from .backend import get_backend
+from .cache import build_key, discard_build, load_build, save_build
+from .vmdk import DEFAULT_BUFFER_SIZE, DEFAULT_COMPRESS_LEVEL, DIGESTS, \
+    default_jobs, process_pool, stream_optimize_vmdk
+
+# Buffer size for copying the disk when the kernel can not do it
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Manifest line, both OVF "SHA1(file)= digest" and BSD "SHA1 (file) = digest"
+MANIFEST_LINE = re.compile(r'^(\w+)\s*\((.+)\)\s*=\s*([0-9a-fA-F]+)$')
+
+class OVAException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return self.msg
+
+NS_CIM  = "{http://schemas.dmtf.org/wbem/wscim/1/common}"
+NS_OVF  = "{http://schemas.dmtf.org/ovf/envelope/1}"
+NS_RASD = "{http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_ResourceAllocationSettingData}"
+NS_VMW  = "{http://www.vmware.com/schema/ovf}"
+NS_VSSD = "{http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_VirtualSystemSettingData}"
+NS_XS   = "{http://www.w3.org/2001/XMLSchema-instance}"
+
+def tar_header(name, size, mtime):
+    """
+    Create GNU tar header for a regular file member
+    """
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = size
+    tarinfo.mtime = mtime
+    tarinfo.mode = 0o644
+    return tarinfo.tobuf(tarfile.GNU_FORMAT)
+
+def member_mtime(reproducible=False):
+    """
+    Return mtime of the tar members: the current time or, for
+    reproducible output, SOURCE_DATE_EPOCH if set and 0 otherwise
+    """
+    if not reproducible:
+        return int(time.time())
+    epoch = os.environ.get('SOURCE_DATE_EPOCH', '0')
+    try:
+        return int(epoch)
+    except ValueError:
+        raise OVAException(f'invalid SOURCE_DATE_EPOCH: {epoch}')
+
+def tar_padding(size):
+    """
+    Zeroes padding tar member data of given size to block boundary
+    """
+    return b'\x00' * (-size % tarfile.BLOCKSIZE)
+
+class TarMemberWriter(object):
+    """
+    Write-only file object that streams data directly into a tar
+    member of a seekable file. The member header is reserved with size
+    0 on creation and patched in place on close, when the size is known
+    """
+
+    def __init__(self, f, name, mtime):
+        self.__f = f
+        self.__name = name
+        self.__mtime = mtime
+        self.__size = 0
+        self.__header_offset = f.tell()
+        # GNU format stores large sizes in base-256, so the header
+        # length does not depend on the size
+        header = tar_header(name, 0, mtime)
+        f.write(header)
+        self.data_offset = self.__header_offset + len(header)
+        self.closed = False
+
+    def write(self, b):
+        self.__f.write(b)
+        self.__size += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.__size
+
+    def flush(self):
+        self.__f.flush()
+
+    def fileno(self):
+        return self.__f.fileno()
+
+    def seek(self, pos):
+        """
+        Move to pos of the member data, used after data was written to
+        the file directly. The member ends at the last position sought
+        """
+        self.__f.seek(self.data_offset + pos)
+        self.__size = pos
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.__f.write(tar_padding(self.__size))
+        end = self.__f.tell()
+        self.__f.seek(self.__header_offset)
+        self.__f.write(tar_header(self.__name, self.__size, self.__mtime))
+        self.__f.seek(end)
+
+def copy_range(src, dst, offset, size):
+    """
+    Copy size bytes at offset of file object src to the current position
+    of file object dst. The copy is done inside the kernel with
+    copy_file_range(2) or sendfile(2) where the platform supports it
+    """
+    dst.flush()
+    pos = dst.tell()
+    end = pos + size
+    src_fd = src.fileno()
+    dst_fd = dst.fileno()
+
+    try:
+        while pos < end:
+            n = os.copy_file_range(src_fd, dst_fd, end - pos, offset, pos)
+            if n == 0:
+                break
+            offset += n
+            pos += n
+    except (AttributeError, OSError):
+        pass
+
+    try:
+        while pos < end:
+            os.lseek(dst_fd, pos, os.SEEK_SET)
+            n = os.sendfile(dst_fd, src_fd, offset, end - pos)
+            if n == 0:
+                break
+            offset += n
+            pos += n
+    except (AttributeError, OSError):
+        pass
+
+    # userland fallback
+    if pos < end:
+        buf = bytearray(COPY_BUFFER_SIZE)
+        with memoryview(buf) as view:
+            src.seek(offset)
+            dst.seek(pos)
+            while pos < end:
+                n = src.readinto(view[:min(len(buf), end - pos)])
+                if not n:
+                    break
+                dst.write(view[:n])
+                pos += n
+
+    if pos < end:
+        raise OSError(f'short copy of {src.name}')
+    dst.seek(end)
+
+class HardwareProfile(object):
+    """
+    Virtual hardware of an OVA variant written to output: number of
+    CPUs, memory size in MB and VM name (the VMDK name by default)
+    """
+
+    def __init__(self, output, cpus=1, memsize=1024, name=None):
+        self.output = output
+        self.cpus = cpus
+        self.memsize = memsize
+        self.name = name
+
+class OVAFile(object):
+
+    def __init__(self, vmdk, cpus=1, memsize=1024, disksize=10, name=None,
+      digests=('sha1',), reproducible=False, **options):
+        """
+        With reproducible the same vmdk and settings always give the
+        same OVA. options are keyword arguments passed to
+        stream_optimize_vmdk
+        """
+        self.__instance = 0
+        self.__vmdk = vmdk
+        self.__cpus = cpus
+        self.__memsize = memsize
+        self.__disksize = disksize
+        self.__digests = digests
+        self.__reproducible = reproducible
+        self.__options = options
+        basename = os.path.basename(vmdk)
+        self.__vmdk_barename = os.path.splitext(basename)[0]
+        if name is None:
+            self.__name = self.__vmdk_barename
+        else:
+            self.__name = name
+
+        ET.register_namespace("cim", "http://schemas.dmtf.org/wbem/wscim/1/common")
+        ET.register_namespace("ovf", "http://schemas.dmtf.org/ovf/envelope/1")
+        ET.register_namespace("rasd", "http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_ResourceAllocationSettingData")
+        ET.register_namespace("vmw", "http://www.vmware.com/schema/ovf")
+        ET.register_namespace("vssd", "http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_VirtualSystemSettingData")
+        ET.register_namespace("xsi", "http://www.w3.org/2001/XMLSchema-instance")
+
+
+    def __add_child(self, e, name, text):
+        new_e = SubElement(e, name)
+        new_e.text = text
+        return new_e
+
+    def __add_config(self, e, name, value, required=False):
+        new_e = SubElement(e, NS_VMW + 'Config')
+        if not required:
+            new_e.set(NS_OVF + 'required', 'false')
+            new_e.set(NS_VMW + 'key', name)
+            new_e.set(NS_VMW + 'value', value)
+        return new_e
+
+    def __add_item(self, e, name, desc, resource_type=None, resource_subtype=None,
+      units=None, quantity=None, address=None, automatic_allocation=None, parent=None,
+      address_on_parent=None, host_resource=None, connection=None):
+        new_e = SubElement(e, 'Item')
+        if address is not None:
+            SubElement(new_e, NS_RASD + 'Address').text = str(address)
+        if address_on_parent is not None:
+            SubElement(new_e, NS_RASD + 'AddressOnParent').text = str(address_on_parent)
+        if units is not None:
+            SubElement(new_e, NS_RASD + 'AllocationUnits').text = str(units)
+        if automatic_allocation is not None:
+            SubElement(new_e, NS_RASD + 'AutomaticAllocation').text = str(automatic_allocation)
+        if connection is not None:
+            SubElement(new_e, NS_RASD + 'Connection').text = str(connection)
+        SubElement(new_e, NS_RASD + 'Description').text = desc
+        SubElement(new_e, NS_RASD + 'ElementName').text = name
+        if host_resource is not None:
+            SubElement(new_e, NS_RASD + 'HostResource').text = str(host_resource)
+        SubElement(new_e, NS_RASD + 'InstanceID').text = str(self.__instance)
+        if parent is not None:
+            SubElement(new_e, NS_RASD + 'Parent').text = str(parent)
+        if resource_subtype is not None:
+            SubElement(new_e, NS_RASD + 'ResourceSubType').text = str(resource_subtype)
+        if resource_type is not None:
+            SubElement(new_e, NS_RASD + 'ResourceType').text = str(resource_type)
+        if quantity is not None:
+            SubElement(new_e, NS_RASD + 'VirtualQuantity').text = str(quantity)
+        i = self.__instance
+        self.__instance += 1
+        return new_e, i
+
+    def __add_network_section(self, envelope):
+        network_section = SubElement(envelope, 'NetworkSection')
+        self.__add_child(network_section, 'Info', 'The list of logical networks')
+        network = SubElement(network_section, 'Network')
+        network.set(NS_OVF + 'name', 'VM Network')
+        self.__add_child(network, 'Description', 'The VM Network network')
+
+    def __add_virtual_system(self, envelope, cpus, memsize, name):
+        vs = SubElement(envelope, 'VirtualSystem')
+        vs.set(NS_OVF + 'id', name)
+        self.__add_child(vs, 'Info', 'A virtual machine')
+        self.__add_child(vs, 'Name', name)
+
+        oss = SubElement(vs, 'OperatingSystemSection')
+        oss.set(NS_OVF + 'id', '78')
+        oss.set(NS_VMW + 'osType', 'freebsd64Guest')
+        SubElement(oss, 'Info').text = 'The kind of installed guest operating system'
+
+        product = SubElement(vs, 'ProductSection')
+        SubElement(product, 'Info').text = 'Information about the installed software'
+        SubElement(product, 'Product').text = ''
+        SubElement(product, 'Vendor').text = ''
+        SubElement(product, 'Version').text = ''
+
+        vhw = SubElement(vs, 'VirtualHardwareSection')
+        SubElement(vhw, 'Info').text = 'Virtual hardware requirements'
+
+        # Add system entry
+        system = SubElement(vhw, 'System')
+        SubElement(system, NS_VSSD + 'ElementName').text = 'Virtual Hardware Family'
+        SubElement(system, NS_VSSD + 'InstanceID').text = str(self.__instance)
+        SubElement(system, NS_VSSD + 'VirtualSystemIdentifier').text = name
+        # This is the VM format type
+        SubElement(system, NS_VSSD + 'VirtualSystemType').text = 'vmx-08'
+        self.__instance += 1
+
+        i, _ = self.__add_item(vhw, f'{cpus} virtual CPU(s)', 'Number of Virtual CPUs',
+            resource_type=3, quantity=cpus, units='hertz * 10^6')
+
+        i, _ = self.__add_item(vhw, f'{memsize}MB of memory', 'Memory Size',
+            resource_type=4, quantity=memsize, units='byte * 2^20')
+
+        # Disable for now as it's not required
+        # i, storage_controller_id = self.__add_item(vhw, 'SCSI Controller 0', 'SCSI Controller',
+        #     resource_type=6, resource_subtype='lsilogic', address=0)
+        # self.__add_config(i, "slotInfo.pciSlotNumber", "16")
+
+        i, storage_controller_id = self.__add_item(vhw, 'ideController0', 'IDE Controller',
+            resource_type=5, resource_subtype='PIIX4', address=0)
+
+        i, _ = self.__add_item(vhw, 'ideController1', 'IDE Controller',
+            resource_type=5, resource_subtype='PIIX4', address=0)
+
+        i, _ = self.__add_item(vhw, 'VirtualVideoCard', 'Virtual Video Card',
+            resource_type=24, automatic_allocation='false')
+        i.set(NS_OVF + 'required', 'false')
+        self.__add_config(i, "enable3DSupport", "false")
+        self.__add_config(i, "enableMPTSupport", "false")
+        self.__add_config(i, "use3dRenderer", "automatic")
+        self.__add_config(i, "useAutoDetect", "false")
+        self.__add_config(i, "videoRamSizeInKB", "4096")
+
+        i, _ = self.__add_item(vhw, 'Hard Disk 1', 'Hard Disk',
+            resource_type=17, parent=storage_controller_id, address_on_parent=0,
+            host_resource='ovf:/disk/vmdisk1')
+        self.__add_config(i, "backing.writeThrough", "false")
+
+        i, _ = self.__add_item(vhw, 'Ethernet 1', 'VmxNet3 ethernet adapter on "VM Network"',
+            resource_type=10, resource_subtype='VmxNet3', address_on_parent=7,
+            automatic_allocation='true', connection="VM Network")
+
+        self.__add_config(i, "slotInfo.pciSlotNumber", "160")
+        self.__add_config(i, "wakeOnLanEnabled", "true")
+
+        self.__add_config(vhw, "cpuHotAddEnabled", "false")
+        self.__add_config(vhw, "cpuHotRemoveEnabled", "false")
+        self.__add_config(vhw, "firmware", "bios")
+        self.__add_config(vhw, "virtualICH7MPresent", "false")
+        self.__add_config(vhw, "virtualSMCPresent", "false")
+        self.__add_config(vhw, "memoryHotAddEnabled", "false")
+        self.__add_config(vhw, "nestedHVEnabled", "false")
+        self.__add_config(vhw, "powerOpInfo.powerOffType", "soft")
+        self.__add_config(vhw, "powerOpInfo.resetType", "soft")
+        self.__add_config(vhw, "powerOpInfo.standbyAction", "checkpoint")
+        self.__add_config(vhw, "powerOpInfo.suspendType", "hard")
+        self.__add_config(vhw, "tools.afterPowerOn", "true")
+        self.__add_config(vhw, "tools.afterResume", "true")
+        self.__add_config(vhw, "tools.beforeGuestShutdown", "true")
+        self.__add_config(vhw, "tools.beforeGuestStandby", "true")
+        self.__add_config(vhw, "tools.syncTimeWithHost", "false")
+        self.__add_config(vhw, "tools.toolsUpgradePolicy", "manual")
+
+    def __generate_ovf(self, cpus, memsize, name, size=None):
+        self.__instance = 0
+        envelope =  Element('Envelope')
+        envelope.set('xmlns', 'http://schemas.dmtf.org/ovf/envelope/1')
+        envelope.set(NS_VMW + 'buildId', 'build-2494585')
+        references = SubElement(envelope, 'References')
+        f = SubElement(references, 'File')
+        f.set(NS_OVF + "href", self.__vmdk_barename + '-drive.vmdk')
+        f.set(NS_OVF + "id", 'file1')
+        if size is None:
+            size = os.path.getsize(self.__vmdk)
+        f.set(NS_OVF + "size", str(size))
+
+        disk_section = SubElement(envelope, 'DiskSection')
+        SubElement(disk_section, 'Info').text = 'Virtual disk information'
+        disk = SubElement(disk_section, 'Disk')
+        disk.set(NS_OVF + 'capacity', str(self.__disksize))
+        disk.set(NS_OVF + 'capacityAllocationUnits', 'byte * 2^30')
+        disk.set(NS_OVF + 'diskId', 'vmdisk1')
+        disk.set(NS_OVF + 'fileRef', 'file1')
+        disk.set(NS_OVF + 'format', 'http://www.vmware.com/interfaces/specifications/vmdk.html#streamOptimized')
+
+        self.__add_network_section(envelope)
+        self.__add_virtual_system(envelope, cpus, memsize, name)
+        out = BytesIO()
+        ET.ElementTree(envelope).write(out, encoding='utf-8', xml_declaration=True)
+
+        dom = xml.dom.minidom.parseString(out.getvalue().decode('utf-8'))
+        return dom.toprettyxml(indent='  ').encode('utf-8')
+
+    def __write_member(self, f, name, data, mtime):
+        f.write(tar_header(name, len(data), mtime))
+        f.write(data)
+        f.write(tar_padding(len(data)))
+
+    def __write_manifest(self, f, files, mtime):
+        """
+        Write the manifest for (name, digests) pairs in files and
+        finish the archive
+        """
+        # OVF 2.0 manifest lines, one per file and algorithm
+        mf = ''
+        for name, digests in files:
+            for d in self.__digests:
+                mf += f'{d.upper()}({name})= {digests[d]}\n'
+        self.__write_member(f, self.__vmdk_barename + '.mf', mf.encode('utf-8'), mtime)
+
+        # End of archive: two zero blocks, padded to full record
+        f.write(b'\x00' * (tarfile.BLOCKSIZE * 2))
+        f.write(b'\x00' * (-f.tell() % tarfile.RECORDSIZE))
+
+    def __ovf_digests(self, ovf):
+        return { d: hashlib.new(d, ovf).hexdigest() for d in self.__digests }
+
+    def write(self, outpath, profiles=()):
+        """
+        Write the OVA to outpath, return ConversionStats of the disk.
+        For every HardwareProfile in profiles another OVA is written,
+        which differs only in its OVF: the disk is converted once and
+        then copied to the other OVAs
+        """
+        ovf = self.__generate_ovf(self.__cpus, self.__memsize, self.__name)
+
+        ovf_name = self.__vmdk_barename + '.ovf'
+        vmdk_name = self.__vmdk_barename + '-drive.vmdk'
+
+        if os.path.exists(outpath):
+            os.unlink(outpath)
+
+        mtime = member_mtime(self.__reproducible)
+
+        # Assemble the tar archive in a single pass: the stream-optimized
+        # VMDK goes straight into its member
+        with open(outpath, 'xb') as ova:
+            self.__write_member(ova, ovf_name, ovf, mtime)
+
+            vmdk_stream = TarMemberWriter(ova, vmdk_name, mtime)
+            with open(self.__vmdk, 'rb') as vmdk_monolith:
+                stats = stream_optimize_vmdk(vmdk_monolith, vmdk_stream,
+                    self.__disksize, digests=self.__digests,
+                    reproducible=self.__reproducible, **self.__options)
+
+            self.__write_manifest(ova, ((ovf_name, self.__ovf_digests(ovf)),
+                (vmdk_name, stats.digests)), mtime)
+
+        if not profiles:
+            return stats
+
+        # The disk member is the same in every variant, so is its digest
+        with open(outpath, 'rb') as source:
+            for profile in profiles:
+                name = profile.name
+                if name is None:
+                    name = self.__vmdk_barename
+                ovf = self.__generate_ovf(profile.cpus, profile.memsize, name)
+
+                if os.path.exists(profile.output):
+                    os.unlink(profile.output)
+
+                with open(profile.output, 'xb') as ova:
+                    self.__write_member(ova, ovf_name, ovf, mtime)
+                    ova.write(tar_header(vmdk_name, stats.output_size, mtime))
+                    copy_range(source, ova, vmdk_stream.data_offset,
+                        stats.output_size)
+                    ova.write(tar_padding(stats.output_size))
+                    self.__write_manifest(ova, ((ovf_name, self.__ovf_digests(ovf)),
+                        (vmdk_name, stats.digests)), mtime)
+
+        return stats
+
+    def repack(self, source, outpath, vmdk_member, vmdk_digests, size):
+        """
+        Write the OVA to outpath reusing tarfile.TarInfo vmdk_member of
+        existing OVA file source, whose digests are already known. Only
+        the OVF and the manifest are generated, the disk is copied as is.
+        size is the ovf:size of the disk file reference
+        """
+        ovf = self.__generate_ovf(self.__cpus, self.__memsize, self.__name,
+            size=size)
+        ovf_name = self.__vmdk_barename + '.ovf'
+        mtime = member_mtime(self.__reproducible)
+
+        if os.path.exists(outpath):
+            os.unlink(outpath)
+
+        with open(source, 'rb') as src, open(outpath, 'xb') as ova:
+            self.__write_member(ova, ovf_name, ovf, mtime)
+            ova.write(tar_header(vmdk_member.name, vmdk_member.size, mtime))
+            copy_range(src, ova, vmdk_member.offset_data, vmdk_member.size)
+            ova.write(tar_padding(vmdk_member.size))
+            self.__write_manifest(ova, ((ovf_name, self.__ovf_digests(ovf)),
+                (vmdk_member.name, vmdk_digests)), mtime)
+
+def parse_ovf(ovf):
+    """
+    Extract hardware and disk settings written by OVAFile from OVF
+    descriptor: dict with cpus, memsize, name, disksize and size
+    """
+    try:
+        envelope = ET.fromstring(ovf)
+    except ET.ParseError as e:
+        raise OVAException(f'invalid OVF descriptor: {e}')
+    settings = {}
+
+    f = envelope.find(f'{NS_OVF}References/{NS_OVF}File')
+    disk = envelope.find(f'{NS_OVF}DiskSection/{NS_OVF}Disk')
+    vs = envelope.find(f'{NS_OVF}VirtualSystem')
+    if f is None or disk is None or vs is None:
+        raise OVAException('OVF descriptor lacks disk or virtual system')
+
+    try:
+        settings['size'] = f.get(NS_OVF + 'size')
+        settings['disksize'] = int(disk.get(NS_OVF + 'capacity'))
+        settings['name'] = vs.get(NS_OVF + 'id')
+
+        for item in vs.iter(NS_OVF + 'Item'):
+            resource_type = item.findtext(NS_RASD + 'ResourceType')
+            quantity = item.findtext(NS_RASD + 'VirtualQuantity')
+            # OVAs built without --cpus have no CPU quantity, the
+            # defaults of the caller apply then
+            if quantity is None:
+                continue
+            if resource_type == '3':
+                settings['cpus'] = int(quantity)
+            elif resource_type == '4':
+                settings['memsize'] = int(quantity)
+    except (TypeError, ValueError) as e:
+        raise OVAException(f'invalid OVF descriptor: {e}')
+
+    return settings
+
+def parse_manifest(mf):
+    """
+    Return manifest digests as dict file -> { algorithm: hex digest }
+    """
+    files = {}
+    for line in mf.decode('utf-8').splitlines():
+        m = MANIFEST_LINE.match(line.strip())
+        if m is None:
+            continue
+        algorithm, name, digest = m.groups()
+        files.setdefault(name, {})[algorithm.lower()] = digest.lower()
+    return files
+
+def repack(source, output=None, cpus=None, memsize=None, name=None,
+      digests=None, reproducible=False):
+    """
+    Rebuild OVA file source with new hardware settings without
+    converting the disk again: the OVF is regenerated and the disk
+    member is copied byte for byte, its digests are taken from the
+    existing manifest. Settings left None keep their current value,
+    digests defaults to the algorithms of the existing manifest.
+    output defaults to replacing source. With reproducible the tar
+    members get fixed mtimes as in convert()
+    """
+    with tarfile.open(source) as tar:
+        members = tar.getmembers()
+        try:
+            ovf_member = next(m for m in members if m.name.endswith('.ovf'))
+            vmdk_member = next(m for m in members if m.name.endswith('-drive.vmdk'))
+            mf_member = next(m for m in members if m.name.endswith('.mf'))
+        except StopIteration:
+            raise OVAException(f'{source}: not an OVA written by freebsd-mkova')
+        settings = parse_ovf(tar.extractfile(ovf_member).read())
+        manifest = parse_manifest(tar.extractfile(mf_member).read())
+
+    # older OVAs may lack the disk file size
+    size = settings['size'] or vmdk_member.size
+
+    vmdk_digests = manifest.get(vmdk_member.name, {})
+    if digests is None:
+        digests = [ d for d in vmdk_digests if d in DIGESTS ]
+    missing = [ d for d in digests if d not in vmdk_digests ]
+    if missing or not digests:
+        raise OVAException(f'{source}: manifest has no {", ".join(missing) or "usable"} '
+            f'digest of {vmdk_member.name}')
+
+    ova = OVAFile(vmdk_member.name[:-len('-drive.vmdk')] + '.vmdk',
+        cpus=settings.get('cpus', 1) if cpus is None else cpus,
+        memsize=settings.get('memsize', 1024) if memsize is None else memsize,
+        disksize=settings['disksize'],
+        name=settings['name'] if name is None else name,
+        digests=digests, reproducible=reproducible)
+
+    if output is None or os.path.abspath(output) == os.path.abspath(source):
+        # write next to the source and replace it once complete
+        temp = source + '.repack'
+        ova.repack(source, temp, vmdk_member, vmdk_digests, size)
+        os.replace(temp, source)
+    else:
+        ova.repack(source, output, vmdk_member, vmdk_digests, size)
+
+def convert(vmdk, output=None, cpus=1, memsize=1024, disksize=10, name=None,
+      digests=('sha1',), profiles=(), reproducible=False, skip_unchanged=False,
+      hash_input=False, **options):
+    """
+    Convert FreeBSD release/snapshot VMDK file vmdk to OVA file output,
+    by default next to vmdk with .ova extension, and to an OVA variant
+    for every HardwareProfile in profiles. options are passed to
+    stream_optimize_vmdk. Return ConversionStats
+
+    With reproducible the output depends only on the content of vmdk
+    and the settings: the content IDs of the disk are derived from
+    vmdk and the tar members get mtime SOURCE_DATE_EPOCH, or 0 if it
+    is not set.
+
+    With skip_unchanged a build record is kept next to output and the
+    conversion is skipped if neither vmdk nor any parameter changed
+    since, the recorded ConversionStats are returned then. vmdk is
+    identified by size and modification time, with hash_input also by
+    its content
+    """
+    if output is None:
+        output = os.path.splitext(vmdk)[0] + '.ova'
+
+    if skip_unchanged:
+        params = dict(cpus=cpus, memsize=memsize, disksize=disksize,
+            name=name, digests=list(digests),
+            profiles=[ [ p.output, p.cpus, p.memsize, p.name ]
+                for p in profiles ],
+            compress_level=options.get('compress_level', DEFAULT_COMPRESS_LEVEL),
+            backend=get_backend(options.get('backend')).name,
+            reproducible=reproducible,
+            epoch=member_mtime(True) if reproducible else None)
+        key = build_key(vmdk, params, content_hash=hash_input)
+        stats = load_build(output, key)
+        if stats is not None:
+            stats.output = output
+            return stats
+        discard_build(output)
+
+    ova = OVAFile(vmdk, cpus=cpus, memsize=memsize, disksize=disksize,
+        name=name, digests=digests, reproducible=reproducible, **options)
+    stats = ova.write(output, profiles=profiles)
+    stats.output = output
+
+    if skip_unchanged:
+        save_build(output, key, stats, [ output ]
+            + [ p.output for p in profiles ])
+    return stats
+
+def convert_batch(images, jobs=None, buffer_size=DEFAULT_BUFFER_SIZE, **options):
+    """
+    Convert several VMDK files, images is a list of (vmdk, output) pairs
+    with output possibly None. Up to jobs images are converted at once
+    and all their grains are compressed on one shared pool of jobs
+    threads, by default as in stream_optimize_vmdk, so small images do
+    not leave it idle while a large one is still running. With processes
+    the pool is one of worker processes. buffer_size is the memory limit
+    of the whole batch, jobs is split between the images running at once
+    for their write threads. Other options are passed to convert().
+    Return list of ConversionStats in the order of images
+    """
+    images = list(images)
+    if jobs is None:
+        jobs = default_jobs(options.get('compress_level'))
+    parallel = max(1, min(jobs, len(images)))
+    share = jobs // parallel
+
+    if options.get('processes'):
+        pool = process_pool(jobs)
+    else:
+        pool = ThreadPoolExecutor(max_workers=jobs)
+
+    with pool, \
+          ThreadPoolExecutor(max_workers=parallel) as runner:
+        results = [ runner.submit(convert, vmdk, output, pool=pool,
+            jobs=share, buffer_size=buffer_size // parallel, **options)
+            for vmdk, output in images ]
+        return [ r.result() for r in results ]
@@ -0,0 +1,1046 @@
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import time
+
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from math import ceil, log2
+from random import randint
+from uuid import uuid1
+
+from .backend import get_backend
+
+log = logging.getLogger(__name__)
+
+SECTOR_SIZE = 512
+
+MAGIC_NUMBER    = 0x564D444B # VMDK
+
+MARKER_EOS      = 0 # end of stream
+MARKER_GT       = 1 # grain table
+MARKER_GD       = 2 # grain directory
+MARKER_FOOTER   = 3 # footer
+
+# Grain marker: virtual sector and size of compressed data
+GRAIN_MARKER_FORMAT = "=QI"
+GRAIN_MARKER_SIZE   = struct.calcsize(GRAIN_MARKER_FORMAT)
+
+ZERO_SECTOR = memoryview(bytes(SECTOR_SIZE))
+
+# Manifest digest algorithms
+DIGESTS = ('sha1', 'sha256', 'sha512')
+
+# Default limit for the amount of grain data in flight between
+# the read, compress and write stages of the conversion
+DEFAULT_BUFFER_SIZE = 256 * 1024 * 1024
+
+# Largest single read of physically contiguous grains
+MAX_READ_SIZE = 4 * 1024 * 1024
+
+# Output is passed on to the file in chunks of this size
+WRITE_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Deflate level of the grains, ADAPTIVE_LEVEL picks one per grain,
+# ARCHIVAL_LEVEL is the highest effort of the deflate backend
+DEFAULT_COMPRESS_LEVEL = 6
+ADAPTIVE_LEVEL = 'adaptive'
+ARCHIVAL_LEVEL = 'archival'
+
+# Adaptive level: the byte entropy of a grain is estimated from every
+# ENTROPY_SAMPLE_STEP-th byte. Grains above INCOMPRESSIBLE_ENTROPY bits
+# per byte (compressed files, e.g. dist tarballs) are stored, deflate
+# would only spend time on them. Grains below COMPRESSIBLE_ENTROPY
+# (file system metadata, sparse and bitmap blocks) deflate to the same
+# size at COMPRESSIBLE_LEVEL in 60% of the time of the default level;
+# higher levels only search longer matches in them
+ENTROPY_SAMPLE_STEP = 64
+INCOMPRESSIBLE_ENTROPY = 7.5
+COMPRESSIBLE_ENTROPY = 2.0
+COMPRESSIBLE_LEVEL = 4
+
+# Part of the grain cache key, bump it whenever a level gives different
+# grains, e.g. the adaptive thresholds or levels change
+GRAIN_CACHE_VERSION = 2
+
+# Descriptor Template
+IMAGE_DESCRIPTOR_TEMPLATE ='''# Disk Descriptor File
+version=1
+CID=#CID#
+parentCID=ffffffff
+createType="streamOptimized"
+
+# Extent description
+RDONLY #SECTORS# SPARSE "stream-optimized.vmdk"
+
+# The Disk Data Base
+#DDB
+
+ddb.adapterType = "ide"
+# #SECTORS# / 63 / 255
+ddb.geometry.cylinders = "#CYLINDERS#"
+ddb.geometry.heads = "255"
+ddb.geometry.sectors = "63"
+ddb.longContentID = "#longCID#"
+ddb.virtualHWVersion = "7"'''
+
+class VMDKException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+    def __str__(self):
+        return self.msg
+
+class ConversionStats(object):
+    """
+    Result of a conversion: grain counters, size and digests of the
+    stream-optimized VMDK and time spent
+    """
+
+    def __init__(self):
+        self.grains = 0          # grains written to the output
+        self.zero_grains = 0     # allocated all-zeroes grains left sparse
+        self.grain_tables = 0    # GrainTables written to the output
+        self.output_size = 0     # bytes
+        self.digests = {}        # algorithm -> hex digest
+        self.elapsed = 0.0       # seconds
+        self.output = None       # path of the OVA, if written by convert()
+        self.reused = False      # True if convert() kept an up-to-date OVA
+        self.backend = None      # name of the deflate backend
+        self.saved_size = 0      # bytes saved over the default level by
+                                 # ARCHIVAL_LEVEL
+
+    def __repr__(self):
+        return f'<ConversionStats grains={self.grains} ' \
+            f'zero_grains={self.zero_grains} output_size={self.output_size} ' \
+            f'elapsed={self.elapsed:.2f}>'
+
+def pad_to_sector(b):
+    """
+    take bytes and pad them to sector-size boundary with zeroes
+    """
+    l = len(b)
+    sectors = ceil(l/SECTOR_SIZE)
+    padding = sectors * SECTOR_SIZE - l
+    if padding:
+        return b + b'\x00' * padding
+    else:
+        return b
+
+class HashingWriter(object):
+    """
+    Write-only file object that passes data through to file object f
+    and hashes it on the way with every algorithm in digests
+    """
+
+    def __init__(self, f, digests=('sha1',)):
+        self.__f = f
+        self.__hashes = [ (d, hashlib.new(d)) for d in digests ]
+
+    def write(self, b):
+        for _, h in self.__hashes:
+            h.update(b)
+        return self.__f.write(b)
+
+    def tell(self):
+        return self.__f.tell()
+
+    def close(self):
+        self.__f.close()
+
+    def hexdigests(self):
+        return { d: h.hexdigest() for d, h in self.__hashes }
+
+class MappedFile(object):
+    """
+    Read-only file object over memory-mapped file object f. read()
+    returns memoryview slices of the mapping, so no data is copied
+    and no system call is made
+    """
+
+    def __init__(self, f):
+        self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__view = memoryview(self.__map)
+        self.__pos = 0
+
+    def seek(self, pos):
+        self.__pos = pos
+
+    def tell(self):
+        return self.__pos
+
+    def read(self, size):
+        b = self.__view[self.__pos:self.__pos + size]
+        self.__pos += len(b)
+        return b
+
+    def close(self):
+        self.__view.release()
+        try:
+            self.__map.close()
+        except BufferError:
+            # slices are still referenced somewhere, the mapping
+            # goes away with the last of them
+            pass
+
+def content_ids(inf, capacity):
+    """
+    Return CID and long content ID derived from the whole content of
+    input file object inf and the output capacity in sectors
+    """
+    h = hashlib.blake2b(struct.pack('=Q', capacity), digest_size=20)
+    inf.seek(0)
+    while True:
+        b = inf.read(MAX_READ_SIZE)
+        if not b:
+            break
+        h.update(b)
+    digest = h.digest()
+    cid = int.from_bytes(digest[:4], 'big')
+    # 0 and ffffffff are not valid content IDs
+    if cid in (0, 0xffffffff):
+        cid = 1
+    return '%08x' % cid, digest[4:].hex()
+
+def read_table(inf, offset, entries):
+    """
+    Read GrainDirectory or GrainTable of entries 32-bit values at
+    offset (in sectors) into a compact array
+    """
+    inf.seek(offset * SECTOR_SIZE)
+    table = array('I')
+    table.frombytes(inf.read(entries * table.itemsize))
+    return table
+
+class ChunkedWriter(object):
+    """
+    Write-only file object that collects output in a preallocated buffer
+    and passes it on to file object f in chunks of chunk_size bytes.
+    The output offset is tracked here, so tell() never touches f
+    """
+
+    def __init__(self, f, chunk_size=WRITE_CHUNK_SIZE):
+        self.__f = f
+        self.__chunk_size = chunk_size
+        self.__buf = bytearray(chunk_size)
+        self.__fill = 0
+        self.__flushed = 0
+
+    def __flush_chunks(self):
+        # Pass on full chunks only, so every write to f but the last one
+        # is chunk-aligned, then move the remainder to the buffer start
+        start = 0
+        with memoryview(self.__buf) as view:
+            while self.__fill - start >= self.__chunk_size:
+                self.__f.write(view[start:start + self.__chunk_size])
+                start += self.__chunk_size
+            if start:
+                view[:self.__fill - start] = view[start:self.__fill]
+        self.__fill -= start
+        self.__flushed += start
+
+    def reserve(self, size):
+        """
+        Return writable memoryview of the next size bytes of output,
+        the caller fills it in place
+        """
+        self.__flush_chunks()
+        end = self.__fill + size
+        if end > len(self.__buf):
+            self.__buf.extend(bytes(end - len(self.__buf)))
+        view = memoryview(self.__buf)[self.__fill:end]
+        self.__fill = end
+        return view
+
+    def write(self, b):
+        with self.reserve(len(b)) as view:
+            view[:] = b
+        return len(b)
+
+    def tell(self):
+        return self.__flushed + self.__fill
+
+    def close(self):
+        with memoryview(self.__buf) as view:
+            self.__f.write(view[:self.__fill])
+        self.__flushed += self.__fill
+        self.__fill = 0
+        self.__f.close()
+
+def pwrite_all(fd, data, offset):
+    """
+    Write buffer data to file descriptor fd at offset
+    """
+    with memoryview(data) as view:
+        while view:
+            n = os.pwrite(fd, view, offset)
+            view = view[n:]
+            offset += n
+
+class PositionalWriter(object):
+    """
+    Write-only file object that lays output out in order but leaves
+    writing it to jobs threads: output is collected in preallocated
+    batches of batch_size bytes, handed out in place by reserve() as in
+    ChunkedWriter. Full batches are hashed in order with every
+    algorithm in digests by a thread of their own and written to their
+    final position in file object f with pwrite, while the next batch
+    is collected. Batches are reused once written. f must be a regular
+    file or support flush(), fileno(), tell() and seek() like one
+    """
+
+    def __init__(self, f, digests=('sha1',), jobs=1,
+          batch_size=WRITE_CHUNK_SIZE):
+        f.flush()
+        self.__f = f
+        self.__fd = f.fileno()
+        self.__start = f.tell()
+        self.__base = os.lseek(self.__fd, 0, os.SEEK_CUR)
+        self.__hashes = [ (d, hashlib.new(d)) for d in digests ]
+        self.__batch_size = batch_size
+        self.__jobs = jobs
+        self.__pool = ThreadPoolExecutor(max_workers=jobs)
+        # one thread keeps the hashes in output order
+        self.__hasher = ThreadPoolExecutor(max_workers=1)
+        self.__writes = []       # (hash future, write future, batch)
+        self.__free = []
+        self.__buf = bytearray(batch_size)
+        self.__fill = 0
+        self.__written = 0
+
+    def __hash(self, data):
+        with memoryview(data) as view:
+            for _, h in self.__hashes:
+                h.update(view)
+
+    def __wait(self):
+        hashed, written, batch = self.__writes.pop(0)
+        hashed.result()
+        written.result()
+        if batch is not None:
+            self.__free.append(batch)
+
+    def __submit(self, data, batch=None):
+        # at most two batches per thread are waiting to be written
+        while len(self.__writes) >= 2 * self.__jobs:
+            self.__wait()
+        self.__writes.append((self.__hasher.submit(self.__hash, data),
+            self.__pool.submit(pwrite_all, self.__fd, data,
+                self.__base + self.__written), batch))
+        self.__written += len(data)
+
+    def __dispatch(self):
+        if not self.__fill:
+            return
+        self.__submit(memoryview(self.__buf)[:self.__fill], self.__buf)
+        # allocate batches until the writes in flight are at their limit
+        if len(self.__writes) >= 2 * self.__jobs:
+            while not self.__free and self.__writes:
+                self.__wait()
+        self.__buf = self.__free.pop() if self.__free else \
+            bytearray(self.__batch_size)
+        self.__fill = 0
+
+    def reserve(self, size):
+        """
+        Return writable memoryview of the next size bytes of output,
+        the caller fills it in place before the next call
+        """
+        if self.__fill + size > len(self.__buf):
+            self.__dispatch()
+        if size > len(self.__buf):
+            # larger than a batch, it gets a batch of its own
+            self.__buf = bytearray(size)
+        view = memoryview(self.__buf)[self.__fill:self.__fill + size]
+        self.__fill += size
+        return view
+
+    def write(self, b):
+        if len(b) >= self.__batch_size:
+            # b is kept until written, callers do not reuse large
+            # buffers such as Segment data
+            self.__dispatch()
+            self.__submit(b)
+            return len(b)
+        with self.reserve(len(b)) as view:
+            view[:] = b
+        return len(b)
+
+    def tell(self):
+        return self.__written + self.__fill
+
+    def close(self):
+        try:
+            self.__dispatch()
+            while self.__writes:
+                self.__wait()
+        finally:
+            self.__pool.shutdown()
+            self.__hasher.shutdown()
+        self.__f.seek(self.__start + self.__written)
+        self.__f.close()
+
+    def hexdigests(self):
+        return { d: h.hexdigest() for d, h in self.__hashes }
+
+def grain_record_size(size):
+    """
+    Return output size of a grain of size bytes of compressed data:
+    marker and data padded to sector size
+    """
+    size += GRAIN_MARKER_SIZE
+    return size + (-size % SECTOR_SIZE)
+
+def write_grain(outf, lba, data):
+    """
+    Write grain marker for virtual sector lba, compressed grain data
+    and padding to sector size into ChunkedWriter outf. The grain is
+    assembled in place in the output buffer
+    """
+    size = GRAIN_MARKER_SIZE + len(data)
+    padded = grain_record_size(len(data))
+
+    with outf.reserve(padded) as view:
+        struct.pack_into(GRAIN_MARKER_FORMAT, view, 0, lba, len(data))
+        view[GRAIN_MARKER_SIZE:size] = data
+        view[size:padded] = ZERO_SECTOR[:padded - size]
+
+def create_marker(marker_type, sectors, size):
+    """
+    Create sector-sized stream-optimized VMDK marker
+    """
+    marker_list = [ sectors, size, marker_type ]
+    marker_list += [0,] * 496
+    return struct.pack("=QII496B", *marker_list)
+
+def default_jobs(level):
+    """
+    Return default number of compression threads for level: all cores
+    for ARCHIVAL_LEVEL, where build time matters little, else one
+    """
+    if level == ARCHIVAL_LEVEL:
+        return os.cpu_count() or 1
+    return 1
+
+def grain_level(grainData):
+    """
+    Return deflate level for grainData by its estimated byte entropy
+    """
+    sample = bytes(grainData[::ENTROPY_SAMPLE_STEP])
+    n = len(sample)
+    entropy = -sum(c * log2(c / n) for c in Counter(sample).values()) / n
+    if entropy > INCOMPRESSIBLE_ENTROPY:
+        return 0
+    if entropy < COMPRESSIBLE_ENTROPY:
+        return COMPRESSIBLE_LEVEL
+    return DEFAULT_COMPRESS_LEVEL
+
+def deflate_grain(grainData, level, backend):
+    """
+    Deflate grainData with level 0-9, ADAPTIVE_LEVEL or ARCHIVAL_LEVEL
+    on DeflateBackend backend
+    """
+    if level == ADAPTIVE_LEVEL:
+        level = grain_level(grainData)
+    elif level == ARCHIVAL_LEVEL:
+        level = backend.best_level
+    return backend.compress(grainData, level)
+
+def compress_grain(grainData, zeroGrain, level, backend, cache=None,
+      baseline=None):
+    """
+    Compress stage of the conversion pipeline: return grain data
+    deflated with level on DeflateBackend backend or None if the grain
+    is all zeroes and can be left sparse. zeroGrain is all-zeroes bytes
+    of the grain size, comparing against it is a plain memcmp. With
+    GrainCache cache, grains compressed before are taken from the cache.
+    With DeflateBackend baseline, return (compressed data, size of the
+    grain deflated with baseline at the default level) instead, the
+    baseline grain is cached as well
+    """
+    # grains past the end of a truncated input read short or empty,
+    # which would pass for all zeroes below
+    if len(grainData) != len(zeroGrain):
+        raise VMDKException('Short read of grain data, input file truncated?')
+
+    # unlike ==, startswith() takes memoryview slices without falling
+    # back to item by item comparison
+    if zeroGrain.startswith(grainData):
+        return None
+
+    compressedGrainData = cached_deflate_grain(grainData, level, backend,
+        cache)
+    if baseline is None:
+        return compressedGrainData
+    return compressedGrainData, len(cached_deflate_grain(grainData,
+        DEFAULT_COMPRESS_LEVEL, baseline, cache))
+
+def cached_deflate_grain(grainData, level, backend, cache):
+    """
+    Return deflate_grain(grainData, level, backend), taken from
+    GrainCache cache if not None
+    """
+    if cache is None:
+        return deflate_grain(grainData, level, backend)
+    key = cache.key(grainData,
+        f'{GRAIN_CACHE_VERSION}:{backend.name}:{level}'.encode())
+    compressedGrainData = cache.get(key)
+    if compressedGrainData is None:
+        compressedGrainData = deflate_grain(grainData, level, backend)
+        cache.put(key, compressedGrainData)
+    return compressedGrainData
+
+def submit_grains(pool, compress, inf, grainBytes, offset, count):
+    """
+    Read count grains at byte offset of file object inf with a single
+    read, submit compress(grainData, zeroGrain) for each of them to
+    thread pool and return their futures
+    """
+    zeroGrain = bytes(grainBytes)
+    inf.seek(offset)
+    # split the run into grains without copying
+    run = memoryview(inf.read(count * grainBytes))
+    return [ pool.submit(compress, run[k * grainBytes:(k + 1) * grainBytes],
+        zeroGrain) for k in range(count) ]
+
+class RunGrain(object):
+    """
+    Result of grain k of a run compressed by a single pool task, future
+    of the list of the grains of the run. Has the result() and cancel()
+    of a future of its own
+    """
+
+    def __init__(self, future, k):
+        self.__future = future
+        self.__k = k
+
+    def result(self):
+        return self.__future.result()[self.__k]
+
+    def cancel(self):
+        return self.__future.cancel()
+
+def process_pool(jobs):
+    """
+    Return ProcessPoolExecutor of jobs worker processes for compress_run.
+    Workers are spawned: forking the threads of a running conversion is
+    not safe
+    """
+    return ProcessPoolExecutor(max_workers=jobs,
+        mp_context=multiprocessing.get_context('spawn'))
+
+def submit_runs(pool, compress, path, identity, grainBytes, offset, count):
+    """
+    Submit compression of count grains at byte offset of input file
+    path with identity to process pool as one task, return a RunGrain
+    for each of them. Only the position of the run goes to the worker,
+    which maps the file itself, and only compressed grains come back
+    """
+    future = pool.submit(compress_run, path, identity, grainBytes, offset,
+        count, compress)
+    return [ RunGrain(future, k) for k in range(count) ]
+
+# Input files mapped by a worker process, (path, identity) -> memoryview
+worker_inputs = {}
+
+def compress_run(path, identity, grainBytes, offset, count, compress):
+    """
+    Compress task of the process pool: return list of compress(grainData,
+    zeroGrain) for count grains at byte offset of input file path. The
+    file is mapped once per worker process, identity tells a replaced
+    file from the one mapped before
+    """
+    view = worker_input(path, identity)
+    zeroGrain = bytes(grainBytes)
+    return [ compress(view[offset + k * grainBytes:offset + (k + 1) * grainBytes],
+        zeroGrain) for k in range(count) ]
+
+def worker_input(path, identity):
+    """
+    Return memoryview of input file path mapped by this worker process,
+    identity tells a replaced file from the one mapped before
+    """
+    view = worker_inputs.get((path, identity))
+    if view is None:
+        with open(path, 'rb') as f:
+            view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        worker_inputs[(path, identity)] = view
+    return view
+
+class Segment(object):
+    """
+    Output of one GrainTable built apart from the rest: the records of
+    its grains and the GrainTable entries pointing to them, in sectors
+    relative to the start of the segment. The write stage relocates the
+    entries to where the segment lands in the output
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.entries = []        # (gteIndex, relative offset)
+        self.zero_grains = 0
+        self.saved_size = 0
+
+def build_segment(grains, firstLBA, grainSize, compress):
+    """
+    Compress grains, a list of (gteIndex, grainData) of one GrainTable,
+    with compress(grainData, zeroGrain) and return their Segment.
+    firstLBA is the first virtual sector of the GrainTable
+    """
+    segment = Segment()
+    zeroGrain = bytes(grainSize * SECTOR_SIZE)
+    for i, grainData in grains:
+        compressedGrainData = compress(grainData, zeroGrain)
+
+        # all-zeroes grain, leave it sparse
+        if compressedGrainData is None:
+            segment.zero_grains += 1
+            continue
+
+        if isinstance(compressedGrainData, tuple):
+            compressedGrainData, baselineSize = compressedGrainData
+            segment.saved_size += grain_record_size(baselineSize) \
+                - grain_record_size(len(compressedGrainData))
+
+        size = GRAIN_MARKER_SIZE + len(compressedGrainData)
+        segment.entries.append((i, len(segment.data) // SECTOR_SIZE))
+        segment.data += struct.pack(GRAIN_MARKER_FORMAT,
+            firstLBA + i * grainSize, len(compressedGrainData))
+        segment.data += compressedGrainData
+        segment.data += ZERO_SECTOR[:-size % SECTOR_SIZE]
+    return segment
+
+def submit_segment(pool, compress, inf, grainSize, numGTEsPerGT, t, runs):
+    """
+    Read runs, a list of (gteIndex, offset, count), of GrainTable t from
+    file object inf and submit building its Segment to thread pool,
+    return the future
+    """
+    grainBytes = grainSize * SECTOR_SIZE
+    grains = []
+    for i, offset, count in runs:
+        inf.seek(offset)
+        run = memoryview(inf.read(count * grainBytes))
+        grains += [ (i + k, run[k * grainBytes:(k + 1) * grainBytes])
+            for k in range(count) ]
+    return pool.submit(build_segment, grains, t * numGTEsPerGT * grainSize,
+        grainSize, compress)
+
+def submit_segment_runs(pool, compress, path, identity, grainSize,
+      numGTEsPerGT, t, runs):
+    """
+    Submit building the Segment of GrainTable t from runs, a list of
+    (gteIndex, offset, count), of input file path with identity to
+    process pool, return the future
+    """
+    return pool.submit(compress_segment, path, identity, grainSize,
+        t * numGTEsPerGT * grainSize, runs, compress)
+
+def compress_segment(path, identity, grainSize, firstLBA, runs, compress):
+    """
+    Segment task of the process pool: build the Segment of the grains in
+    runs, a list of (gteIndex, offset, count), of input file path
+    """
+    view = worker_input(path, identity)
+    grainBytes = grainSize * SECTOR_SIZE
+    grains = [ (i + k, view[offset + k * grainBytes:offset + (k + 1) * grainBytes])
+        for i, offset, count in runs for k in range(count) ]
+    return build_segment(grains, firstLBA, grainSize, compress)
+
+def grain_runs(gt, grainSize, maxRun):
+    """
+    Yield (gteIndex, offset, count) for the allocated grains of GrainTable
+    gt, grouped in runs of up to maxRun grains that follow each other in
+    the sparse file. offset is in sectors
+    """
+    i = 0
+    while i < len(gt):
+        offset = gt[i]
+
+        # zero-filled grain, nothing to write
+        if offset <= 1:
+            i += 1
+            continue
+
+        n = 1
+        while n < maxRun and i + n < len(gt) and \
+              gt[i + n] == offset + n * grainSize:
+            n += 1
+
+        yield i, offset, n
+        i += n
+
+def read_grains(inf, gdes, numGTEsPerGT, grainSize, maxRun, pending, stop,
+      submit, segments=False):
+    """
+    Read stage of the conversion pipeline: load GrainTables one at a
+    time, pass runs of their allocated grains to submit(offset, count),
+    which starts their compression and returns a future for each grain,
+    and queue the pending results for the write stage in their original
+    order. Runs are up to maxRun grains contiguous in the input file.
+    Grains are queued as (gtIndex, gteIndex, future), every GrainTable
+    is followed by (gtIndex, None, None). None marks the end of the
+    stream.
+
+    With segments all runs of a GrainTable go to submit(gtIndex, runs)
+    at once, runs is a list of (gteIndex, offset, count), and the
+    GrainTable is queued as (gtIndex, None, future of its Segment)
+    """
+    try:
+        for t, gt_offset in enumerate(gdes):
+            if stop.is_set():
+                return
+
+            # unallocated GrainTable, nothing to read
+            if gt_offset == 0:
+                pending.put((t, None, None))
+                continue
+
+            gt = read_table(inf, gt_offset, numGTEsPerGT)
+
+            if segments:
+                runs = [ (i, offset * SECTOR_SIZE, n)
+                    for i, offset, n in grain_runs(gt, grainSize, maxRun) ]
+                # blocks once the write stage falls behind
+                pending.put((t, None, submit(t, runs)))
+                continue
+
+            for i, offset, n in grain_runs(gt, grainSize, maxRun):
+                if stop.is_set():
+                    return
+
+                futures = submit(offset * SECTOR_SIZE, n)
+                for k in range(n):
+                    # blocks once the write stage falls behind
+                    pending.put((t, i + k, futures[k]))
+
+            pending.put((t, None, None))
+
+        pending.put(None)
+    except BaseException as e:
+        pending.put(e)
+
+def stream_optimize_vmdk(inf, outf, newsize, jobs=None,
+      buffer_size=DEFAULT_BUFFER_SIZE, digests=('sha1',), use_mmap=False,
+      pool=None, cache=None, reproducible=False,
+      compress_level=DEFAULT_COMPRESS_LEVEL, backend=None, processes=False,
+      segments=False, positional=False):
+    """
+    Convert monolithSparse VMDK file object inf to stream-optimized
+    VMDK file object outf and resize it to newsize gigabytes.
+    Return ConversionStats with hex digests of the output for every
+    algorithm in digests, all computed in the same pass.
+
+    Reading, compression and writing run concurrently: grains are
+    compressed by up to jobs threads, by default one or all cores with
+    ARCHIVAL_LEVEL, and at most buffer_size bytes of grain data are in
+    flight between the stages. Alternatively grains are compressed on
+    executor pool, which may be shared by several conversions. With
+    processes the pool, own or given, is a ProcessPoolExecutor: runs
+    of grains are compressed by worker processes mapping the input
+    file themselves, so grain data is not passed between processes.
+    inf must then be a named file and no cache can be used. With
+    segments a task compresses all grains of a GrainTable into a
+    Segment with relative offsets, which the write stage relocates;
+    buffer_size should then allow for at least jobs GrainTables of
+    grains, fewer keep only as many jobs busy and log a warning. With
+    use_mmap the input file is memory-mapped and grains are passed to
+    the compressor without copying. With GrainCache cache, compressed
+    grains are reused across conversions. With reproducible the
+    content IDs of the descriptor are derived from the input instead
+    of being random, at the cost of reading it twice. Grains are
+    deflated with compress_level 0-9 or, with ADAPTIVE_LEVEL, with a
+    level chosen by the estimated entropy of each grain or, with
+    ARCHIVAL_LEVEL, with the highest effort of the deflate backend, in
+    which case ConversionStats.saved_size tells the size saved over
+    the default level. The named deflate backend is used, by default
+    the fastest one installed. With positional the write stage only
+    lays the output out, hashing it and writing it to its final
+    position is left to a thread and jobs threads using pwrite, outf
+    must then be a regular file or a TarMemberWriter
+    """
+
+    stats = ConversionStats()
+    started = time.monotonic()
+
+    backend = get_backend(backend)
+    stats.backend = backend.name
+
+    # archival compression is measured against what the default level
+    # of the default backend would give
+    archival = compress_level == ARCHIVAL_LEVEL
+    compress = partial(compress_grain, level=compress_level, backend=backend,
+        cache=cache, baseline=get_backend() if archival else None)
+
+    if jobs is None:
+        jobs = default_jobs(compress_level)
+
+    if processes:
+        if cache is not None:
+            raise VMDKException('grain cache can not be used with processes')
+        try:
+            path = os.path.realpath(inf.name)
+        except (AttributeError, TypeError):
+            raise VMDKException('processes require an input file with a name')
+        st = os.fstat(inf.fileno())
+        identity = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    if use_mmap:
+        inf = MappedFile(inf)
+
+    header_struct = "=IIIQQQQIQQQBccccH433B"
+    sparse_header = inf.read(SECTOR_SIZE)
+    fields = struct.unpack(header_struct, sparse_header)
+    magicNumber, version, flags, capacity, grainSize, descriptorOffset, \
+        descriptorSize, numGTEsPerGT, rgdOffset, gdOffset, overHead, \
+        uncleanShutdown, singleEndLineChar, nonEndLineChar, doubleEndLineChar1, \
+        doubleEndLineChar2, compressAlgorithm  = fields[:-433]
+
+    if magicNumber != MAGIC_NUMBER:
+        raise VMDKException('Invalid magic number in input file, not a valid VMDK?')
+
+    inputCapacity = capacity
+
+    # Override some header values
+    version = 3
+    rgdOffset = 0
+    flags = 0x30001
+    compressAlgorithm = 1 # deflate
+    capacity = ceil(newsize*1024*1024*1024/SECTOR_SIZE)
+
+    if capacity < inputCapacity:
+        raise VMDKException('requested image size is less than the original file')
+
+    # Round up to GT size
+    sectorsInGT = grainSize * numGTEsPerGT
+    newGTs = ceil(capacity/sectorsInGT)
+    capacity = newGTs * sectorsInGT
+    new_header_fields = [ magicNumber, version, flags, capacity,
+                grainSize, descriptorOffset, descriptorSize, numGTEsPerGT,
+                rgdOffset, gdOffset, overHead, uncleanShutdown,
+                b'\n', b' ', b'\r', b'\n', compressAlgorithm ]
+
+    totalGrains = ceil(inputCapacity/grainSize)
+    totalGTs = ceil(totalGrains/numGTEsPerGT)
+
+    # Load the GrainDirectory, GrainTables are loaded by the read
+    # stage when their turn comes
+    gdes = read_table(inf, gdOffset, totalGTs)
+
+    # Prepare new image descriptor
+    if reproducible:
+        cid, longcid = content_ids(inf, capacity)
+    else:
+        cid = '%08x' %  randint(1, 0xffffffff)
+        longcid = str(uuid1()).replace('-', '')
+    cylinders = ((capacity + (63*255) - 1) / (63*255))
+    image_descriptor_str = IMAGE_DESCRIPTOR_TEMPLATE
+    image_descriptor_str = image_descriptor_str.replace("#CID#", cid)
+    image_descriptor_str = image_descriptor_str.replace("#longCID#", longcid)
+    image_descriptor_str = image_descriptor_str.replace("#SECTORS#", str(capacity))
+    image_descriptor_str = image_descriptor_str.replace("#CYLINDERS#", str(cylinders))
+    image_descriptor = pad_to_sector(image_descriptor_str.encode('ascii'))
+
+    new_header_fields += [0] * 433
+    sparse_header = struct.pack(header_struct, *new_header_fields)
+
+    # Hash everything as it is written, in large chunks. Positional
+    # output only lays out the records here, as soon as their size is
+    # known, and leaves hashing and writing them to threads
+    if positional:
+        outf = hasher = PositionalWriter(outf, digests, jobs)
+    else:
+        hasher = HashingWriter(outf, digests)
+        outf = ChunkedWriter(hasher)
+
+    # Write sparse header, image descriptor
+    # and pad with zeroes up to overHead sectors
+    outf.write(sparse_header)
+    outf.write(image_descriptor)
+    padlen = overHead * SECTOR_SIZE - outf.tell()
+    if padlen > 0:
+        outf.write(b'\x00' * padlen)
+
+    newGrainDirectory = array('I')
+
+    # prepare stock GrainTable with all zeroes for fast comparisons
+    emptyGT = array('I', bytes(numGTEsPerGT * newGrainDirectory.itemsize))
+    newGT = array('I', emptyGT)
+
+    # Limit the number of grains between the read and write stages,
+    # the read stage blocks when the queue is full
+    maxPending = max(1, buffer_size // (grainSize * SECTOR_SIZE))
+    maxRun = max(1, min(maxPending, MAX_READ_SIZE // (grainSize * SECTOR_SIZE)))
+    if segments:
+        maxPending = max(1, maxPending // numGTEsPerGT)
+        if maxPending < jobs:
+            log.warning('buffer size of %d MB holds %d grain tables '
+                'for %d jobs, the other jobs stay idle',
+                buffer_size // (1024 * 1024), maxPending, jobs)
+    pending = queue.Queue(maxPending)
+    stop = threading.Event()
+
+    # zlib releases the GIL while deflating, so worker threads are
+    # enough to keep several cores busy
+    ownPool = pool is None
+    if ownPool:
+        pool = process_pool(jobs) if processes else \
+            ThreadPoolExecutor(max_workers=jobs)
+    grainBytes = grainSize * SECTOR_SIZE
+    if segments and processes:
+        submit = partial(submit_segment_runs, pool, compress, path, identity,
+            grainSize, numGTEsPerGT)
+    elif segments:
+        submit = partial(submit_segment, pool, compress, inf, grainSize,
+            numGTEsPerGT)
+    elif processes:
+        submit = partial(submit_runs, pool, compress, path, identity,
+            grainBytes)
+    else:
+        submit = partial(submit_grains, pool, compress, inf, grainBytes)
+    reader = threading.Thread(target=read_grains,
+        args=(inf, gdes, numGTEsPerGT, grainSize, maxRun, pending, stop,
+            submit, segments),
+        daemon=True)
+    reader.start()
+
+    try:
+        # Write stage: pending grains come in their original order
+        # so the output does not depend on the number of jobs
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+
+            t, i, result = item
+
+            if i is not None:
+                compressedGrainData = result.result()
+
+                # all-zeroes grain, leave it sparse
+                if compressedGrainData is None:
+                    stats.zero_grains += 1
+                    continue
+
+                if archival:
+                    compressedGrainData, baselineSize = compressedGrainData
+                    stats.saved_size += grain_record_size(baselineSize) \
+                        - grain_record_size(len(compressedGrainData))
+
+                if outf.tell() % SECTOR_SIZE:
+                    raise VMDKException('Invalid output offset while writing grain data')
+
+                # get the offset (in sectors) of the grain in output file
+                # and record it in the current GrainTable. The size of GT
+                # in infile and outfile is the same
+                newGT[i] = int(outf.tell() / SECTOR_SIZE)
+
+                # Write grain marker (12 bytes) then compressed data, then
+                # pad it to sector size
+                inPtr = (t * numGTEsPerGT + i) * grainSize
+                write_grain(outf, inPtr, compressedGrainData)
+                stats.grains += 1
+                continue
+
+            # GrainTable built as a Segment: relocate its entries to
+            # where it lands in the output
+            if result is not None:
+                segment = result.result()
+                base = outf.tell() // SECTOR_SIZE
+                for i, offset in segment.entries:
+                    newGT[i] = base + offset
+                outf.write(segment.data)
+                stats.grains += len(segment.entries)
+                stats.zero_grains += segment.zero_grains
+                stats.saved_size += segment.saved_size
+
+            # If GTi is all zeroes, no need to write anything
+            # mark it as 0-offset in GrainDirectory
+            if newGT == emptyGT:
+                newGrainDirectory.append(0)
+                continue
+
+            gt, newGT = newGT, array('I', emptyGT)
+
+            # Write current GrainTable
+            if outf.tell() % SECTOR_SIZE:
+                raise VMDKException('Invalid output offset while writing GrainTable marker')
+            # First GT marker with size
+            gt_marker = create_marker(MARKER_GT, int(len(gt) * 4 / SECTOR_SIZE), 0)
+            outf.write(gt_marker)
+
+            # Get GTi offset (in sectors) in output file
+            pos = outf.tell()
+            if pos % SECTOR_SIZE:
+                raise VMDKException('Invalid output offset while writing GrainTable data')
+            pos = int(pos / SECTOR_SIZE)
+            # Write GTi content
+            outf.write(gt.tobytes())
+
+            # and add the GT offset to new GrainDirectory
+            newGrainDirectory.append(pos)
+            stats.grain_tables += 1
+    finally:
+        # Unblock and wait for the read stage if the write stage failed,
+        # dropping compressions that are not needed anymore
+        stop.set()
+        while reader.is_alive() or not pending.empty():
+            try:
+                item = pending.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if isinstance(item, tuple) and item[2] is not None:
+                item[2].cancel()
+        reader.join()
+        if ownPool:
+            pool.shutdown()
+
+    # add zeroed-out GrainTable-s to the new GrainDirectory
+    # to reach the requested image size
+    paddingGTs = newGTs - len(newGrainDirectory)
+    if paddingGTs > 0:
+        newGrainDirectory.frombytes(bytes(paddingGTs * newGrainDirectory.itemsize))
+
+    # Pad the content of the GrainDirectory to sector size
+    newGD = pad_to_sector(newGrainDirectory.tobytes())
+
+    # Write GD marker
+    directory_marker = create_marker(MARKER_GD, int(len(newGD)/SECTOR_SIZE), 0)
+    outf.write(directory_marker)
+
+    # Get offset (in sectors) of the new GrainDirectory
+    # in the output file
+    pos = outf.tell()
+    if pos % SECTOR_SIZE:
+        raise VMDKException('Invalid output offset while writing GrainDirectory data')
+    gdOffset = int(pos / SECTOR_SIZE)
+
+    # Write new GrainDirectory data
+    outf.write(newGD)
+
+    outf.write(create_marker(MARKER_FOOTER, 1, 0))
+
+    # Update the GrainDirectory location in the footer sparse header
+    new_header_fields[9] = gdOffset
+    sparse_header_footer = struct.pack(header_struct, *new_header_fields)
+    outf.write(sparse_header_footer)
+
+    # And done
+    outf.write(create_marker(MARKER_EOS, 0, 0))
+    stats.output_size = outf.tell()
+    outf.close()
+
+    if use_mmap:
+        inf.close()
+
+    stats.digests = hasher.hexdigests()
+    stats.elapsed = time.monotonic() - started
+    return stats